@@ -28,24 +28,64 @@ open and keepalive messages as required, and perform other operations
 (chiefly running "canned programmes" that might send BGP routes) as
 requested on stdin or on the command line.
 
-This will probably not work on Windows because of how it uses 'select'."""
+Commands on stdin are read on a separate thread, and only sockets are
+waited on with a selector; but it hasn't been tried on Windows."""
 
 ## ## ## Top matter
 
 import socket
 import sys
+import os
 import time
-import select
-from traceback import format_exc, print_exc
+import selectors
+import heapq
+import itertools
+import functools
+import threading
+import queue
+from traceback import print_exc
 
 from bgpy_misc import dbg
 import bgpy_misc as bmisc
 import bgpy_repr as brepr
 import bgpy_oper as boper
-from bgpy_prog import register_programmes
 
 ## ## ## Command interface on stdin
 
+class RunningProgramme(object):
+    """State of a canned programme that Commanding has started: see
+    Commanding.register_programme()."""
+
+    __slots__ = ["pname", "it", "t", "seq"]
+    def __init__(self, pname, it):
+        self.pname = pname  # name of the programme
+        self.it = it        # iterator that runs it
+        self.t = None       # when it's to run next, as yielded by 'it'
+        self.seq = None     # sequence number of its entry in the
+                            # Commanding object's programme_heap, if any
+
+@functools.lru_cache(maxsize = 256)
+def split_command_line(line):
+    """Split a command line into words, ignoring any comment.  Returns
+    a tuple.  Remembers recent results, since scripts tend to repeat
+    the same commands."""
+    return(tuple(bmisc.supersplit(line, end_at = "#")))
+
+# text of the "help" command
+command_help = (
+    "# Commands:\n"
+    "#   after seconds cmd... -- run a command after delay\n"
+    "#   echo ... -- write arbitrary text to output\n"
+    "#   exit -- exit bgpy_clnt entirely\n"
+    "#   pause programme -- pause a running programme\n"
+    "#   quiet -- reduce output\n"
+    "#   noquiet -- undo the effect of 'quiet'\n"
+    "#   resume programme -- resume a paused programme\n"
+    "#   run programme [args] -- start a canned programme\n"
+    "#   stop programme -- stop a running programme\n"
+    "\n"
+)
+
 class Commanding(object):
     """Command interface of bgpy_clnt.  Handle commands that are meant
     to come in on stdin.  Each command takes up a line. One command is "help".
@@ -56,24 +96,39 @@ class Commanding(object):
         # programme_handlers maps the name of a programme to its handler; see
         # register_programme()
         #
-        # programme_iterators maps the name of a programme already started
-        # to its iterator; see register_programme().
+        # programmes maps the name of a programme already started to its
+        # RunningProgramme object.
+        #
+        # programme_heap is a priority queue (see heapq) of the programmes
+        # that are to run at a particular time.  Each is listed as a 3-tuple
+        # consisting of the time, a sequence number, and the RunningProgramme.
+        # Entries go stale when a programme is rescheduled, paused, or
+        # stopped; they're discarded when they reach the top of the heap.
+        # The sequence numbers come from programme_seq.
         #
-        # programme_iterator_times indicates when each should run; 0 means
-        # immediately; None means it's suspended
+        # programmes_polled holds the programmes that are waiting on
+        # something other than the time (boper.NEXT_TIME, boper.RIGHT_NOW,
+        # boper.WHILE_TX_PENDING) and have to be checked each time through.
         #
         # client is the client object to which the commands apply,
         # which will in turn be passed to programme handlers etc.
         #
-        # deferred_commands is a list of commands that have been scheduled
-        # for running later, with "after".  Each is listed as a 2-tuple
-        # consisting of the time it's to be run at, and the words of
-        # the command.  The list is kept sorted.
+        # err is the client's error channel, where command output goes.
+        #
+        # deferred_commands is a priority queue (see heapq) of commands that
+        # have been scheduled for running later, with "after".  Each is
+        # listed as a 3-tuple consisting of the time it's to be run at, a
+        # sequence number from deferred_seq (so those with the same time
+        # run in the order given), and the words of the command.
         self.client = client
+        self.err = client.get_error_channel()
         self.programme_handlers = dict()
-        self.programme_iterators = dict()
-        self.programme_iterator_times = dict()
+        self.programmes = dict()
+        self.programme_heap = []
+        self.programme_seq = itertools.count()
+        self.programmes_polled = dict()
         self.deferred_commands = []
+        self.deferred_seq = itertools.count()
 
     def register_programme(self, pname, phandler):
         """Register a 'canned programme', with the given name, and a handler.
@@ -98,253 +153,378 @@ class Commanding(object):
                 make it soon.
         """
         if type(pname) is not str:
-            raise TypeError("internal: handler name not a string: "+repr(pname))
+            raise TypeError("internal: handler name not a string: {!r}"
+                            .format(pname))
         if pname in self.programme_handlers:
-            raise KeyError("internal: handler already registered: \""+
-                           pname+"\"")
+            raise KeyError("internal: handler already registered:"
+                           " \"{}\"".format(pname))
         self.programme_handlers[pname] = phandler
 
+    def schedule_programme(self, prog, t):
+        """Record when the RunningProgramme 'prog' is to run next; 't' is
+        as described for register_programme(), or 0 to run it right away."""
+
+        self.cancel_programme_entry(prog)
+        prog.t = t
+        if t is None:
+            pass # paused; nothing to schedule
+        elif (t is boper.NEXT_TIME or t is boper.RIGHT_NOW or
+              t is boper.WHILE_TX_PENDING):
+            self.programmes_polled[prog.pname] = prog
+        else:
+            prog.seq = next(self.programme_seq)
+            heapq.heappush(self.programme_heap, (t, prog.seq, prog))
+
+    def unschedule_programme(self, prog):
+        "Forget about the RunningProgramme 'prog' entirely."
+
+        del self.programmes[prog.pname]
+        self.cancel_programme_entry(prog)
+
+    def cancel_programme_entry(self, prog):
+        """Take the RunningProgramme 'prog' out of programme_heap and
+        programmes_polled.  Its heap entry just goes stale, which is cheap;
+        but if stale entries pile up (from lots of pausing and stopping)
+        the heap gets rebuilt without them."""
+
+        self.programmes_polled.pop(prog.pname, None)
+        if prog.seq is None:
+            return # wasn't in the heap
+        prog.seq = None
+        heap = self.programme_heap
+        if len(heap) > 2 * len(self.programmes) + 16:
+            heap[:] = [e for e in heap if e[2].seq == e[1]]
+            heapq.heapify(heap)
+
     def handle_command(self, line):
-        "Handle an input command 'line'"
+        "Handle an input command 'line', a string"
 
-        # Break the line into words if it isn't already.
-        if type(line) is str:
-            words = []
-            try:
-                words = bmisc.supersplit(line, end_at = "#")
-            except Exception as e:
-                print("Unable to parse command line: "+str(e),
-                      file=self.client.get_error_channel())
-                if dbg.estk:
-                    print_exc(file=self.client.get_error_channel())
-                return
-        else:
-            words = line
+        # Break the line into words.
+        try:
+            words = list(split_command_line(line))
+        except Exception as e:
+            err = self.err
+            print("Unable to parse command line: {}".format(e),
+                  file=err)
+            if dbg.estk:
+                print_exc(file=err)
+            return
+        self.handle_words(words)
+
+    def handle_words(self, words):
+        "Handle a command already broken into a list of 'words'"
 
         # ignore an empty command line
         if not words: return
 
         # the first word is the command, handle it
-        if words[0] == "help":
-            print("# Commands:\n"+
-                  "#   after seconds cmd... -- run a command after delay\n"+
-                  "#   echo ... -- write arbitrary text to output\n"+
-                  "#   exit -- exit bgpy_clnt entirely\n"+
-                  "#   pause programme -- pause a running programme\n"+
-                  "#   quiet -- reduce output\n"+
-                  "#   noquiet -- undo the effect of 'quiet'\n"+
-                  "#   resume programme -- resume a paused programme\n"+
-                  "#   run programme [args] -- start a canned programme\n"+
-                  "#   stop programme -- stop a running programme\n",
-                  file=self.client.get_error_channel())
-        elif words[0] == "run":
-            if len(words) < 2:
-                print("Missing program name in 'run'",
-                      file=self.client.get_error_channel())
-                return
-            pname = words[1]
-            if pname not in self.programme_handlers:
-                print("Unknown programme name '"+pname+"'.",
-                      file=self.client.get_error_channel())
-                return
-            if pname in self.programme_iterators:
-                print("Programme '"+pname+"' already running.",
-                      file=self.client.get_error_channel())
-                return
-            try:
-                it = self.programme_handlers[pname](self, self.client,
-                                                    words[2:])
-            except Exception as e:
-                print("Programme '"+pname+"' had error: "+
-                      repr(e), file=self.client.get_error_channel())
-                if dbg.estk:
-                    print_exc(file=self.client.get_error_channel())
-                return
-            if it is None:
-                # Huh, programme completed immediately instead of producing
-                # an iterator.  No need to remember it, it's done.
-                pass
-            else:
-                self.programme_iterators[pname] = it
-                self.programme_iterator_times[pname] = 0
-        elif words[0] == "pause":
-            if len(words) != 2:
-                print("Syntax error in 'pause'",
-                      file=self.client.get_error_channel())
-                return
-            pname = words[1]
-            if pname not in self.programme_handlers:
-                print("Unknown programme name '"+pname+"'.",
-                      file=self.client.get_error_channel())
-                return
-            if pname not in self.programme_iterators:
-                print("Programme '"+pname+"' not running.",
-                      file=self.client.get_error_channel())
-                return
-            self.programme_iterator_times[pname] = None
-        elif words[0] == "quiet":
-            if len(words) != 1:
-                print("Syntax error in 'quiet'",
-                      file=self.client.get_error_channel())
-                return
-            self.client.quiet = True
-            if self.client.wrpsok is not None:
-                self.client.wrpsok.set_quiet(True)
-        elif words[0] == "noquiet":
-            if len(words) != 1:
-                print("Syntax error in 'noquiet'",
-                      file=self.client.get_error_channel())
-                return
-            self.client.quiet = False
-            if self.client.wrpsok is not None:
-                self.client.wrpsok.set_quiet(False)
-        elif words[0] == "resume":
-            if len(words) != 2:
-                print("Syntax error in 'resume'",
-                      file=self.client.get_error_channel())
-                return
-            pname = words[1]
-            if pname not in self.programme_handlers:
-                print("Unknown programme name '"+pname+"'.",
-                      file=self.client.get_error_channel())
-                return
-            if pname not in self.programme_iterators:
-                print("Programme '"+pname+"' not running.",
-                      file=self.client.get_error_channel())
-                return
-            self.programme_iterator_times[pname] = 0
-        elif words[0] == "stop":
-            if len(words) != 2:
-                print("Syntax error in 'stop'",
-                      file=self.client.get_error_channel())
-                return
-            pname = words[1]
-            if pname not in self.programme_handlers:
-                print("Unknown programme name "+repr(pname)+".",
-                      file=self.client.get_error_channel())
-                return
-            if pname not in self.programme_iterators:
-                print("Programme "+repr(pname)+" not running.",
-                      file=self.client.get_error_channel())
-                return
-            del self.programme_iterators[pname]
-            del self.programme_iterator_times[pname]
-        elif words[0] == "echo":
-            print(" ".join(words[1:]),
-                  file=self.client.get_error_channel())
-        elif words[0] == "after":
-            err = None
-            try:
-                delay = float(words[1])
-            except Exception as e:
-                err = "delay must be a number"
-                delay = 1
-            if not (delay >= 0):
-                err = "delay must not be negative"
-            if len(words) < 3:
-                err = "missing arguments"
-            if err is not None:
-                print("Error in 'after': "+err,
-                      file=self.client.get_error_channel())
-                return
-
-            # Add to deferred_commands while keeping that list sorted.
-            # A binary search would make this rather more efficient.
-            delay_to = bmisc.tor.get() + delay
-            wher = 0
-            for wher in range(len(self.deferred_commands)):
-                if self.deferred_commands[wher][0] > delay_to:
-                    break
-            self.deferred_commands[wher:wher] = ((delay_to, words[2:]),)
-        elif words[0] == "exit":
-            if len(words) != 1:
-                print("Syntax error in 'exit'",
-                      file=self.client.get_error_channel())
-            sys.exit(0)
+        err = self.err
+        handler = self.commands.get(words[0])
+        if handler is None:
+            print("Unknown command {!r}".format(words[0]),
+                  file=err)
+            return
+        handler(self, words, err)
+
+    # Handlers for the individual commands, listed in commands below.  Each
+    # is passed the words of the command and the error channel.
+
+    def _cmd_help(self, words, err):
+        err.write(command_help)
+
+    def _cmd_run(self, words, err):
+        if len(words) < 2:
+            print("Missing program name in 'run'",
+                  file=err)
+            return
+        pname = words[1]
+        phandler = self.programme_handlers.get(pname)
+        if phandler is None:
+            print("Unknown programme name '{}'.".format(pname),
+                  file=err)
+            return
+        if pname in self.programmes:
+            print("Programme '{}' already running.".format(pname),
+                  file=err)
+            return
+        try:
+            it = phandler(self, self.client, words[2:])
+        except Exception as e:
+            print("Programme '{}' had error: {!r}".format(pname, e), file=err)
+            if dbg.estk:
+                print_exc(file=err)
+            return
+        if it is None:
+            # Huh, programme completed immediately instead of producing
+            # an iterator.  No need to remember it, it's done.
+            pass
         else:
-            print("Unknown command "+repr(words[0]),
-                  file=self.client.get_error_channel())
+            prog = RunningProgramme(pname, it)
+            self.programmes[pname] = prog
+            self.schedule_programme(prog, 0)
+
+    def running_programme(self, words, err):
+        """Check the syntax of a command taking a single programme name,
+        like 'pause', and look the programme up.  Return its
+        RunningProgramme, or None (after reporting the problem) if it's
+        not running."""
+        if len(words) != 2:
+            print("Syntax error in '{}'".format(words[0]),
+                  file=err)
+            return(None)
+        pname = words[1]
+        if pname not in self.programme_handlers:
+            print("Unknown programme name {!r}.".format(pname),
+                  file=err)
+            return(None)
+        prog = self.programmes.get(pname)
+        if prog is None:
+            print("Programme {!r} not running.".format(pname),
+                  file=err)
+        return(prog)
+
+    def _cmd_pause(self, words, err):
+        prog = self.running_programme(words, err)
+        if prog is not None:
+            self.schedule_programme(prog, None)
+
+    def _cmd_quiet(self, words, err):
+        if len(words) != 1:
+            print("Syntax error in 'quiet'",
+                  file=err)
             return
+        self.client.quiet = True
+        if self.client.wrpsok is not None:
+            self.client.wrpsok.set_quiet(True)
+
+    def _cmd_noquiet(self, words, err):
+        if len(words) != 1:
+            print("Syntax error in 'noquiet'",
+                  file=err)
+            return
+        self.client.quiet = False
+        if self.client.wrpsok is not None:
+            self.client.wrpsok.set_quiet(False)
+
+    def _cmd_resume(self, words, err):
+        prog = self.running_programme(words, err)
+        if prog is not None:
+            self.schedule_programme(prog, 0)
+
+    def _cmd_stop(self, words, err):
+        prog = self.running_programme(words, err)
+        if prog is not None:
+            self.unschedule_programme(prog)
+
+    def _cmd_echo(self, words, err):
+        err.write(" ".join(words[1:]) + "\n")
+
+    def _cmd_after(self, words, err):
+        problem = None
+        try:
+            delay = float(words[1])
+        except Exception as e:
+            problem = "delay must be a number"
+            delay = 1
+        if not (delay >= 0):
+            problem = "delay must not be negative"
+        if len(words) < 3:
+            problem = "missing arguments"
+        if problem is not None:
+            print("Error in 'after': {}".format(problem),
+                  file=err)
+            return
+
+        delay_to = bmisc.tor.get() + delay
+        heapq.heappush(self.deferred_commands,
+                       (delay_to, next(self.deferred_seq), words[2:]))
+
+    def _cmd_exit(self, words, err):
+        if len(words) != 1:
+            print("Syntax error in 'exit'",
+                  file=err)
+        sys.exit(0)
+
+    # commands maps the name of each command to the method that handles it
+    commands = {
+        "help": _cmd_help,
+        "run": _cmd_run,
+        "pause": _cmd_pause,
+        "quiet": _cmd_quiet,
+        "noquiet": _cmd_noquiet,
+        "resume": _cmd_resume,
+        "stop": _cmd_stop,
+        "echo": _cmd_echo,
+        "after": _cmd_after,
+        "exit": _cmd_exit
+    }
 
     def invoke(self, now):
         """If any pending programme or deferred command is to be run by
         the time 'now', do it; return the time in seconds before the next
         is to run, or None if there isn't any."""
 
-        # This could be made more scalable with a priority queue, but
-        # it's not really worth it for the intended use here.
+        # nothing to do at all: the usual case, with an idle session
+        if not self.deferred_commands and not self.programmes:
+            return(None)
+
+        # the special values programmes can yield, looked up just once
+        WHILE_TX_PENDING = boper.WHILE_TX_PENDING
+        RIGHT_NOW = boper.RIGHT_NOW
+
+        # the connection's SocketWrap
+        wrpsok = self.client.wrpsok
 
         while self.deferred_commands and self.deferred_commands[0][0] <= now:
-            dcwhat = self.deferred_commands[0][1]
-            self.deferred_commands[0:1] = ()
-            self.handle_command(dcwhat)
+            dcwhat = heapq.heappop(self.deferred_commands)[2]
+            self.handle_words(dcwhat)
 
         if self.deferred_commands:
             time_next = self.deferred_commands[0][0]
         else:
             time_next = None
-        for pname in list(self.programme_iterator_times):
-            # find out what the recorded time to run the iterator is
-            t = self.programme_iterator_times[pname]
-
-            # shall we run it now?
-            if t is None:
-                # Paused indefinitely.
-                run_it = False
-            elif t is boper.NEXT_TIME:
-                # This is "next time"
-                run_it = True
-            elif t is boper.RIGHT_NOW:
-                # This is "now"
-                run_it = True
-            elif t is boper.WHILE_TX_PENDING:
+
+        # Figure out which programmes to run: those whose time has come,
+        # and those waiting on something that has happened.  Collect
+        # them all before running any, so that each runs at most once.
+        heap = self.programme_heap
+        to_run = []
+        while heap and heap[0][0] <= now:
+            (t, seq, prog) = heapq.heappop(heap)
+            if prog.seq == seq:
+                prog.seq = None
+                to_run.append(prog)
+            # else it's a stale entry, skip it
+        for prog in self.programmes_polled.values():
+            if prog.t is WHILE_TX_PENDING:
                 # Run if the outbound buffer is empty.
-                run_it = (len(self.client.wrpsok.opnd) <= 0)
-            elif t <= now:
-                # Now it's time.
-                run_it = True
+                if not wrpsok.opnd:
+                    to_run.append(prog)
             else:
-                # It's not yet time.
-                run_it = False
-
-            # If so, go for it.
-            if run_it:
-                iterator = self.programme_iterators[pname]
-                try:
-                    t = next(iterator)
-                    self.programme_iterator_times[pname] = t
-                except StopIteration:
-                    del self.programme_iterator_times[pname]
-                    del self.programme_iterators[pname]
-                except Exception as e:
-                    print("Programme '"+pname+"' had error: "+
-                          repr(e), file=self.client.get_error_channel())
-                    if dbg.estk:
-                        print_exc(file=self.client.get_error_channel())
-                    del self.programme_iterator_times[pname]
-                    del self.programme_iterators[pname]
-
-            # And account for the next time it's to run if any.
-            if t is None:
-                pass # waiting indefinitely
-            elif t is boper.NEXT_TIME:
-                pass # waiting until something else wakes us up
-            elif t is boper.RIGHT_NOW:
+                # boper.NEXT_TIME or boper.RIGHT_NOW: run every time
+                to_run.append(prog)
+
+        # Run them.
+        programmes = self.programmes
+        for prog in to_run:
+            if programmes.get(prog.pname) is not prog or prog.t is None:
+                continue # stopped (maybe restarted) or paused in the meantime
+            try:
+                t = next(prog.it)
+            except StopIteration:
+                self.unschedule_programme(prog)
+                continue
+            except Exception as e:
+                err = self.err
+                print("Programme '{}' had error: {!r}".format(prog.pname, e),
+                      file=err)
+                if dbg.estk:
+                    print_exc(file=err)
+                self.unschedule_programme(prog)
+                continue
+            self.schedule_programme(prog, t)
+
+        # And account for the next time any is to run.
+        while heap and heap[0][2].seq != heap[0][1]:
+            heapq.heappop(heap) # stale entry, discard
+        if heap and (time_next is None or heap[0][0] < time_next):
+            time_next = heap[0][0] # a time to wake up, before we were planning
+        for prog in self.programmes_polled.values():
+            if prog.t is RIGHT_NOW:
                 time_next = now # just go around again, no waiting
-            elif t is boper.WHILE_TX_PENDING:
+            elif prog.t is WHILE_TX_PENDING:
                 # We're to wait for the outbound buffer to empty.
-                if len(self.client.wrpsok.opnd) <= 0:
+                if not wrpsok.opnd:
                     time_next = 0 # already happened
                 else:
                     # Hasn't happened yet; we'll come back here by the time
                     # it does.
                     pass
-            elif time_next is None or t < time_next:
-                time_next = t # a time to wake up, before we were planning to
+            else:
+                pass # boper.NEXT_TIME: waiting until something else wakes us
 
         if time_next is None:   return(None)
         else:                   return(max(0, time_next - now))
 
+class CommandReader(object):
+    """Reads command lines from a file (normally stdin) on a background
+    thread, so that a slow or partial line doesn't hold up everything
+    else.  The lines are handed over through a bounded queue; and for
+    each batch of them a byte is written to a socket pair, so that
+    select() can wait for them along with everything else.  Usage:
+        create one and start() it
+        register it for reading with a selector (or select())
+        when it becomes readable, call get_lines()"""
+
+    def __init__(self, infile, qsize = 64, bufsize = 65536):
+        self.infile = infile
+        self.bufsize = bufsize
+        self.queue = queue.Queue(qsize)
+        (self.wake_r, self.wake_w) = socket.socketpair()
+        self.thread = threading.Thread(target = self.read_lines,
+                                       name = "CommandReader",
+                                       daemon = True)
+
+    def start(self):
+        "Start reading on the background thread."
+        self.thread.start()
+
+    def fileno(self):
+        "File descriptor that select() will find readable when there's input"
+        return(self.wake_r.fileno())
+
+    def read_lines(self):
+        """Body of the background thread: read input in chunks, split it
+        into lines, and queue them, a list per chunk.  An empty string
+        is queued at end of file."""
+        fd = self.infile.fileno()
+        encoding = self.infile.encoding
+        buf = bytearray()
+        while True:
+            try:
+                chunk = os.read(fd, self.bufsize)
+            except InterruptedError:
+                continue # interrupted by a signal; just try again
+            except BlockingIOError:
+                # Something sharing the file made it non-blocking; wait
+                # until there's input, then try again.
+                with selectors.DefaultSelector() as wsel:
+                    wsel.register(fd, selectors.EVENT_READ)
+                    wsel.select()
+                continue
+            except OSError as e:
+                # can't read any more (hangup etc): report it, and treat
+                # it as end of file
+                print("Error reading commands: {}".format(e),
+                      file=sys.stderr, flush=True)
+                chunk = b""
+            buf += chunk
+            parts = buf.split(b"\n")
+            buf = parts.pop() # incomplete line if any, keep it for later
+            lines = [part.decode(encoding, "replace") + "\n" for part in parts]
+            if not len(chunk):
+                # end of file; pass along any incomplete last line
+                if len(buf):
+                    lines.append(buf.decode(encoding, "replace"))
+                lines.append("")
+            if len(lines):
+                self.queue.put(lines)
+                self.wake_w.send(b"\0")
+            if not len(chunk):
+                break # end of file
+
+    def get_lines(self):
+        """Return a list of the lines read since last time, without waiting.
+        Only call it when select() has indicated there's something."""
+        self.wake_r.recv(4096)
+        lines = []
+        try:
+            while True:
+                lines.extend(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return(lines)
+
 ## ## ## Client class: one end of a BGP peering
 
 def default_holdtime_expiry(clnt):
@@ -355,6 +535,16 @@ def default_holdtime_expiry(clnt):
 
     bmisc.stamprint("Hold time expired.")
 
+def tune_socket(sok):
+    """Set socket options suited to a BGP connection on the connected
+    socket 'sok': BGP messages are small, so don't let Nagle's algorithm
+    or delayed acks hold them up; and use TCP keepalives."""
+
+    sok.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sok.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_QUICKACK"): # Linux only
+        sok.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
 class Client(object):
     """Main class of the bgpy_clnt application.  Holds state and settings
     and has ways to make things happen."""
@@ -413,10 +603,9 @@ class Client(object):
         if type(router_id) is int:
             if (router_id >> 32):
                 raise ValueError("Router id must be 32 bits")
-            ba = bytearray()
-            bmisc.ba_put_be4(ba, router_id)
-            router_id = ba
-        router_id = bytes(router_id)
+            router_id = router_id.to_bytes(4, "big")
+        elif type(router_id) is not bytes:
+            router_id = bytes(router_id)
         if len(router_id) != 4:
             raise ValueError("Router id must be 32 bits")
         self.router_id = router_id
@@ -450,6 +639,7 @@ class Client(object):
 
         # get a connection
         sok, remote = self.sok.accept()
+        tune_socket(sok)
 
         # close and replace the socket since we won't be accepting
         # any more connections on it
@@ -460,7 +650,7 @@ class Client(object):
         self.listen_mode = False
 
         # and announce what's happened
-        bmisc.stamprint("Accepted connection from "+repr(remote))
+        bmisc.stamprint("Accepted connection from {!r}".format(remote))
 
 ## ## ## Command line parameter handling
 
@@ -504,6 +694,13 @@ equal_parms.add("passive",
                 "Accept (one) connection instead of initiating one",
                 bmisc.EqualParms_parse_num_rng(mn=0, mx=1))
 equal_parms.parse("passive=0") # default value
+
+equal_parms.add("sndbuf", "TCP send buffer size in bytes (0 for default)",
+                bmisc.EqualParms_parse_num_rng(mn=0, mx=2**31-1))
+equal_parms.parse("sndbuf=0") # default value
+equal_parms.add("rcvbuf", "TCP receive buffer size in bytes (0 for default)",
+                bmisc.EqualParms_parse_num_rng(mn=0, mx=2**31-1))
+equal_parms.parse("rcvbuf=0") # default value
 pre_commands = []
 equal_parms.add_at_list(pre_commands)
 
@@ -519,7 +716,7 @@ def usage():
           file=sys.stderr)
     print("Named parameters recognized:", file=sys.stderr)
     for n, d in equal_parms.describe():
-        print("\t"+n+": "+d, file=sys.stderr)
+        print("\t{}: {}".format(n, d), file=sys.stderr)
     print("Even with 'passive=1', peer-address is required (though barely"+
           " used.)", file= sys.stderr)
     sys.exit(1)
@@ -563,11 +760,28 @@ if equal_parms["local-addr"] != "" or equal_parms["passive"]:
 
 sok = socket.socket(af, socket.SOCK_STREAM, socket.IPPROTO_TCP)
 
+# Buffer sizes have to be set before connecting (or listening) to have
+# their full effect.  Larger ones may help when sending lots of updates.
+try:
+    if equal_parms["sndbuf"]:
+        sok.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                       equal_parms["sndbuf"])
+    if equal_parms["rcvbuf"]:
+        sok.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                       equal_parms["rcvbuf"])
+except Exception as e:
+    print("Failed to set socket buffer size: {}".format(e),
+          file=sys.stderr)
+    if dbg.estk:
+        print_exc(file=sys.stderr)
+    sys.exit(1)
+
 if bind_to is not None:
     try:
         sok.bind(bind_to)
     except Exception as e:
-        print("Failed to bind to "+repr(bind_to)+": "+str(e), file=sys.stderr)
+        print("Failed to bind to {!r}: {}".format(bind_to, e),
+              file=sys.stderr)
         if dbg.estk:
             print_exc(file=sys.stderr)
         sys.exit(1)
@@ -582,11 +796,12 @@ else:
     try:
         sok.connect(connect_addr)
     except Exception as e:
-        print("Failed to connect to "+peer_addr+" port "+
-              str(brepr.BGP_TCP_PORT)+": "+str(e), file=sys.stderr)
+        print("Failed to connect to {} port {}: {}"
+              .format(peer_addr, brepr.BGP_TCP_PORT, e), file=sys.stderr)
         if dbg.estk:
             print_exc(file=sys.stderr)
         sys.exit(1)
+    tune_socket(sok)
     listen_mode = False
 
 c = Client(sok = sok,
@@ -600,105 +815,132 @@ if equal_parms["tcp-hex"]:
     # hex dump of all data sent/received over TCP
     tcp_hex_ipos = [0]
     tcp_hex_opos = [0]
+    tcp_hex_bytes = tuple(map("{:02x} ".format, range(256)))
 
     def tcp_hex_handler(wrpsok, rw, data):
         if len(data) == 0: return # nothing to do
 
-        if rw == "r":   (posa, rws) = (tcp_hex_ipos, "tcp-rcv")
-        else:           (posa, rws) = (tcp_hex_opos, "tcp-snd")
-
-        bmisc.stamprint(rws+", "+str(len(data))+" bytes:")
+        (posa, rws) = ((tcp_hex_ipos, "tcp-rcv") if rw == "r" else
+                       (tcp_hex_opos, "tcp-snd"))
 
-        # byte values
-        vs = list(map("{:02x}".format, data))
+        bmisc.stamprint("{}, {} bytes:".format(rws, len(data)))
 
-        # padding for alignment with posa[0]
-        vs = ["  "] * (posa[0] & 15) + vs
+        # byte values, three characters each ("xx "), after padding for
+        # alignment with posa[0]
+        hx = ("   " * (posa[0] & 15) +
+              "".join(map(tcp_hex_bytes.__getitem__, data)))
 
-        # display as lines, 16 bytes per line, with an address prefixed to it
-        i = 0
-        for i in range(0, len(vs), 16):
-            print("{}.{:010x}: {}".format(rws, ((posa[0] & ~15) + i),
-                                          " ".join(vs[i : (i + 16)])),
-                  file=sys.stderr)
+        # display as lines, 16 bytes per line, with an address prefixed to
+        # each; and write them all at once
+        addr = posa[0] & ~15
+        fmt = (rws + ".{:010x}: {}\n").format
+        sys.stderr.write("".join([fmt(addr + i // 3, hx[i : (i + 48)].rstrip())
+                                  for i in range(0, len(hx), 48)]))
         posa[0] += len(data)
 
     c.env.data_cb = tcp_hex_handler
 
 cmdi = Commanding(c)
+from bgpy_prog import register_programmes # not needed until now
 register_programmes(cmdi)
 for cmd in pre_commands:
     cmdi.handle_command(cmd)
 
 # and then do... stuff: the main event loop
 
-bmisc.tor.set()
+tor_set = bmisc.tor.set
+t = tor_set() # time of record, updated after each wait
 
+cmdrd = CommandReader(sys.stdin)
+cmdrd.start()
 stdin_closed = False
 
+# Wait for I/O with a selector, which is kept from one pass to the next;
+# registrations only change when what we're waiting for changes.
+sel = selectors.DefaultSelector()
+sel.register(cmdrd, selectors.EVENT_READ)
+sok_mask = 0 # events c.sok is registered for; 0 if it isn't
+
+# Debug flags are only set on the command line, so this one can be
+# checked once.  (An unset FlagSet flag is found by way of __getattr__(),
+# which is comparatively slow.)
+dbg_sokw = dbg.sokw
+
+# Things used on every pass, looked up once.
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+invoke = cmdi.invoke
+handle_command = cmdi.handle_command
+sel_select = sel.select
+
 while True:
     # Run any pending "programmes" and figure out how long until the next
-    # scheduled event if any; this provides a timeout for select().
-    timeo = cmdi.invoke(bmisc.tor.get())
+    # scheduled event if any; this provides a timeout for the selector.
+    timeo = invoke(t)
 
-    # build socket lists for select()
-    rlist = []
-    wlist = []
-    xlist = []
+    # figure out what events to wait for on the socket
     if c.wrpsok is not None:
         # there's a connection, see what we can do on it
-        if c.wrpsok.want_recv(): rlist.append(c.sok)
-        if c.wrpsok.want_send(): wlist.append(c.sok)
+        mask = c.wrpsok.io_mask
     elif c.listen_mode:
         # we're listening for a connection, see if there is one
-        rlist.append(c.sok)
-
-    # Add the command interface (stdin).  Windows won't like this since it's
-    # not a socket.
-    if not stdin_closed:
-        rlist.append(sys.stdin)
-
-    if dbg.sokw:
-        bmisc.stamprint("select" + repr((rlist, wlist, xlist, timeo)))
+        mask = EVENT_READ
+    else:
+        mask = 0
+    if mask != sok_mask:
+        if sok_mask == 0:
+            sel.register(c.sok, mask)
+        elif mask == 0:
+            sel.unregister(c.sok)
+        else:
+            sel.modify(c.sok, mask)
+        sok_mask = mask
 
-    (rlist, wlist, xlist) = select.select(rlist, wlist, xlist, timeo)
+    if dbg_sokw:
+        bmisc.stamprint("select" + repr((sok_mask, not stdin_closed, timeo)))
 
-    bmisc.tor.set()
+    sok_events = 0
+    cmd_ready = False
+    for key, events in sel_select(timeo):
+        if key.fileobj is cmdrd:
+            cmd_ready = True
+        else:
+            sok_events = events
 
-    t = bmisc.tor.get()
+    t = tor_set()
 
-    if dbg.sokw:
-        bmisc.stamprint("select => " + repr((rlist, wlist, xlist)))
+    if dbg_sokw:
+        bmisc.stamprint("select => " + repr((sok_events, cmd_ready)))
 
-    if c.sok in wlist:
+    if sok_events & EVENT_WRITE:
         # send some of any pending messages
         c.wrpsok.able_send()
-    if c.sok in rlist:
+    if sok_events & EVENT_READ:
         if c.listen_mode:
-            # accept a connection
+            # accept a connection; it replaces the listening socket
+            sel.unregister(c.sok)
+            sok_mask = 0
             c.accept_connection()
         else:
             # receive some messages
             if not c.wrpsok.able_recv():
                 bmisc.stamprint("Connection was closed")
                 break
-    if sys.stdin in rlist:
-        # Read a command.  Note that if stdin has only part of a line,
-        # not a whole line, this is going to block; the whole program
-        # will pause until the rest of the line comes in.  But that's
-        # an abnormal case.  And alternatives I've tried don't work
-        # right.
-        cmdbuf = sys.stdin.readline()
-        if cmdbuf == "":
-            # End of file
-            bmisc.stamprint("EOF on stdin (command channel), won't read")
-            stdin_closed = True
-        try:
-            cmdi.handle_command(cmdbuf)
-        except Exception as e:
-            print("Command failure: "+str(e), file=sys.stderr)
-            if dbg.estk:
-                print_exc(file=sys.stderr)
+    if cmd_ready:
+        # Handle the commands that have been read.
+        for cmdbuf in cmdrd.get_lines():
+            if cmdbuf == "":
+                # End of file
+                bmisc.stamprint("EOF on stdin (command channel), won't read")
+                sel.unregister(cmdrd)
+                stdin_closed = True
+                continue
+            try:
+                handle_command(cmdbuf)
+            except Exception as e:
+                print("Command failure: {}".format(e), file=sys.stderr)
+                if dbg.estk:
+                    print_exc(file=sys.stderr)
 
     # read messages that we've received
     while True:
@@ -708,12 +950,21 @@ while True:
         try:
             msg = c.wrpsok.recv()
         except Exception as e:
-            bmisc.stamprint("Recv err: " + repr(e))
+            bmisc.stamprint("Recv err: {!r}".format(e))
             if dbg.estk:
-                for line in format_exc().split("\n"):
-                    if line != "":
-                        bmisc.stamprint("    " + line)
+                print_exc(file=sys.stderr)
+            # recv() has consumed that message (it refuses a length that
+            # wouldn't let it do so), so go on to the next one
+            continue
         if msg is None:
+            if c.wrpsok.ibroke:
+                # recv() gave up on the input (bad message length) and queued
+                # a Notification; send it, and end as if the connection
+                # had been closed
+                if c.wrpsok.opnd:
+                    c.wrpsok.able_send()
+                bmisc.stamprint("Connection was closed")
+                sys.exit(0)
             break       # no more messages
         elif msg.type == brepr.msg_type.OPEN:
             # received an Open message -- keep track of it
@@ -724,8 +975,11 @@ while True:
                         if cap.code == brepr.capabilities.as4:
                             as4_num = bmisc.ParseCtx(cap.val).get_be4()
                             c.env.as4 = c.as4_us
-                            bmisc.stamprint("Peer advertised 4-byte AS ("+
-                                            str(as4_num)+")")
+                            if not c.quiet:
+                                bmisc.stamprint("Peer advertised 4-byte AS"
+                                                " ({})".format(as4_num))
                         if cap.code == brepr.capabilities.refr:
-                            bmisc.stamprint("Peer advertised route-refresh")
+                            if not c.quiet:
+                                bmisc.stamprint("Peer advertised"
+                                                " route-refresh")
 
@@ -24,7 +24,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 "Miscelleneous utility routines and classes used by bgpy."
 
-import time, sys, socket, time, random
+import time, sys, socket, time, random, re
 
 common_prng = random.Random(time.time())
 
@@ -81,37 +81,53 @@ dbg = FlagSet()
 
 def supersplit(s, end_at = None):
     """Split a string into a list of words (other strings), respecting
-    quotes and backslashes."""
+    quotes and backslashes.  If 'end_at' is given (a single character)
+    then it, when not quoted or escaped, ends the string."""
+
+    if "\\" not in s and "\"" not in s:
+        # Nothing quoted or escaped, so str.split() can do the work.
+        if end_at is not None:
+            s = s.partition(end_at)[0]
+        return(s.split())
 
     words = []
     chars = []
     quotemode = False
 
-    for (ch, lit) in superchars(s, append_chars=[(" ", False)]):
-        if lit:
-            # This character is taken literally
-            chars.append(ch)
+    # Go through it a token at a time: a backslash sequence, a quote,
+    # a run of whitespace, or a run of anything else.
+    for tok in superchars_re.findall(s):
+        if tok[0] == "\\":
+            # This is taken literally
+            chars.append(superchar_escape(tok))
+            continue
         elif quotemode:
-            if ch == "\"":
+            if tok == "\"":
                 quotemode = False
             else:
-                chars.append(ch)
-        elif ch is end_at:
+                chars.append(tok)
+            continue
+        ended = False
+        if end_at is not None:
+            cut = tok.find(end_at)
+            if cut >= 0:
+                tok = tok[:cut]
+                ended = True
+        if tok == "\"":
+            quotemode = True
+        elif tok[:1].isspace():
             if chars:
                 words.append("".join(chars))
                 chars = []
+        elif tok:
+            chars.append(tok)
+        if ended:
             break
-        elif ch.isspace():
-            if chars:
-                words.append("".join(chars))
-                chars = []
-        elif ch == "\"":
-            quotemode = True
-        else:
-            chars.append(ch)
 
     if quotemode:
         raise Exception("Unterminated quote")
+    if chars:
+        words.append("".join(chars))
 
     return(words)
 
@@ -124,49 +140,58 @@ superchar_singles = {
     'f': chr(12)
 }
 
+# superchars_re -- matches the tokens supersplit() and superchars() work
+# with: a backslash sequence, a quote, whitespace, or other characters
+superchars_re = re.compile(r'\\(?:x.{0,2}|u.{0,4}|[0-9].{0,2}|.)?' +
+                           r'|"|\s+|[^\\"\s]+', re.S)
+
+def superchar_escape(tok):
+    """Return the character represented by a backslash sequence 'tok'
+    (as matched by superchars_re)."""
+
+    if len(tok) < 2:
+        raise Exception("dangling backslash")
+    ch = tok[1]
+    if ch in superchar_singles:
+        return(superchar_singles[ch])
+    elif ch == "x" or ch == "u":
+        return(chr(int(tok[2:], 16)))
+    elif ch >= '0' and ch <= '9':
+        return(chr(int(tok[1:], 8)))
+    else:
+        return(ch)
+
 def superchars(s, append_chars=[]):
     """Handle backslashes in a string, returning backslashed characters
-    differently from the base characters themselves.  Used by supersplit().
+    differently from the base characters themselves.
     Yields 2-tuples: character, and a boolean indicating whether it's
     escaped somehow."""
 
-    i = 0
-    l = len(s)
-    while i < l:
-        if s[i] == "\\":
-            i += 1
-            if i >= l:
-                raise Exception("dangling backslash")
-            if s[i] in superchar_singles:
-                yield(superchar_singles[s[i]], True)
-                i += 1
-            elif s[i] == "x":
-                yield(chr(int(s[i+1:i+3], 16)), True)
-                i += 3
-            elif s[i] == "u":
-                yield(chr(int(s[i+1:i+5], 16)), True)
-                i += 5
-            elif s[i] >= '0' and s[i] <= '9':
-                yield(chr(int(s[i:i+3], 8)), True)
-                i += 3
-            else:
-                yield (s[i], True)
-                i += 1
+    for tok in superchars_re.findall(s):
+        if tok[0] == "\\":
+            yield(superchar_escape(tok), True)
         else:
-            yield (s[i], False)
-            i += 1
+            for ch in tok:
+                yield(ch, False)
     for tuple in append_chars:
         yield(tuple)
 
+# stamprint_secs -- the most recent whole second stamprint() has formatted,
+# as a list of the second and its text; saves redoing it for every message
+stamprint_secs = [None, ""]
+
 def stamprint(msg):
     """Print a time stamped message 'msg'"""
 
     t = tor.get() # stamp it with the time of record
     ts = int(t)
     tu = round((t - ts) * 1e+6)
-    print("{}.{:06d} {}".
-            format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
-                   tu, msg), file=sys.stderr, flush=True)
+    if stamprint_secs[0] != ts:
+        stamprint_secs[1] = time.strftime("%Y-%m-%d %H:%M:%S",
+                                          time.localtime(ts))
+        stamprint_secs[0] = ts
+    print("{}.{:06d} {}".format(stamprint_secs[1], tu, msg),
+          file=sys.stderr, flush=True)
 
 class ConstantSet(object):
     """A set of constants which can be accessed as attributes easily.
@@ -189,15 +214,17 @@ class ConstantSet(object):
 
     def value2name(self, value):
         "reverse mapping -- value to short name"
-        if value in self._reverse:
-            return(self._reverse[value])
+        name = self._reverse.get(value)
+        if name is not None:
+            return(name)
         else:
             return(repr(value))
 
     def value2printable_name(self, value):
         "reverse mapping -- value to printable name"
-        if value in self._reverse:
-            return(self._printable_names[self._reverse[value]])
+        name = self._reverse.get(value)
+        if name is not None:
+            return(self._printable_names[name])
         else:
             return(repr(value))
 
@@ -577,6 +604,7 @@ class EqualParms(object):
         self.values = dict() # values parsed if any
         self.storers = dict() # callbacks to store results
         self.ats = None # "@" strings: a list() if enabled
+        self.sorted_names = None # sorted(self.seen), computed when needed
 
     def add_alias(self, name, cname):
         """Define an alias, named 'name', pointing to 'cname'."""
@@ -584,7 +612,10 @@ class EqualParms(object):
         if cname not in self.seen:
             raise KeyError("Dangling alias")
         self.seen.add(name);
-        self.aliases[name] = cname
+        self.sorted_names = None
+        # point straight at the canonical name, even if 'cname' is itself
+        # an alias, so parse() needs only one lookup
+        self.aliases[name] = self.aliases.get(cname, cname)
 
     def add(self, name, desc, parser = None, storer = None):
         """Define a name 'name'.  'desc' is its description.
@@ -595,6 +626,7 @@ class EqualParms(object):
 
         if name in self.seen: raise KeyError("Name redefined")
         self.seen.add(name)
+        self.sorted_names = None
         self.descs[name] = desc
         if parser is not None: self.parsers[name] = parser
         if storer is not None: self.storers[name] = storer
@@ -614,7 +646,9 @@ class EqualParms(object):
     def describe(self):
         "Iterate over names known, with descriptions, for help purposes."
 
-        for name in sorted(self.seen):
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.seen)
+        for name in self.sorted_names:
             if name in self.descs:
                 desc = self.descs[name]
             elif name in self.aliases:
@@ -642,19 +676,17 @@ class EqualParms(object):
             else:
                 raise Exception("unrecognized name \"" + n +
                                 "\" in name=value pair")
-        while n in self.aliases:
-            n = self.aliases[n]
-        if n in self.values:
-            pv = self.values[n]
-        else:
-            pv = None
-        if n in self.parsers:
-            v2 = self.parsers[n](self, n, pv, v)
+        n = self.aliases.get(n, n)
+        pv = self.values.get(n)
+        parser = self.parsers.get(n)
+        if parser is not None:
+            v2 = parser(self, n, pv, v)
         else:
             v2 = v
         self.values[n] = v2
-        if n in self.storers:
-            self.storers[n](v2)
+        storer = self.storers.get(n)
+        if storer is not None:
+            storer(v2)
 
     def parse_file(self, file):
         """Parse name=value pairs from a file.  Blank lines and lines
@@ -688,14 +720,12 @@ class EqualParms(object):
 
     def __getitem__(self, n):
         "Look up the value last parsed for name 'n'."
-        while n in self.aliases:
-            n = self.aliases[n]
+        n = self.aliases.get(n, n)
         return(self.values[n])
 
     def __setitem__(self, n, v):
         "Set the value for name 'n' bypassing the parser."
-        while n in self.aliases:
-            n = self.aliases[n]
+        n = self.aliases.get(n, n)
         self.values[n] = v
 
 def EqualParms_parse_num_rng(t = int, tn = "integer", mn = None, mx = None):
@@ -731,13 +761,10 @@ def EqualParms_parse_i32_ip(ep, n, pv, s):
     four bytes); will also take 32-bit unsigned integers."""
 
     try:
-        return(parse_ipv4(s))
-    except: pass
-    try:
-        i = EqualParms_parse_i32(ep, n, pv, s)
-        ba = bytearray()
-        ba_put_be4(ba, i)
-        return(bytes(ba))
+        if "." in s:
+            return(parse_ipv4(s))
+        else:
+            return(EqualParms_parse_i32(ep, n, pv, s).to_bytes(4, "big"))
     except: pass
     raise Exception(n+" must be either an IPv4 address in dotted"+
                     " quad format, or an integer in 0-4294967295 range.")
@@ -797,6 +824,10 @@ def parse_ipv4(s):
     subs = s.split(".")
     if len(subs) != 4:
         raise Exception(repr(s)+" is not four dot-delimited components")
+    try:
+        return(bytes(map(int, subs)))
+    except ValueError:
+        pass # go through them one by one to find the bad one
     ba = bytearray()
     for sub in subs:
         try:
@@ -36,40 +36,59 @@ from bgpy_misc import dbg
 import bgpy_misc as bmisc
 import bgpy_repr as brepr
 from bgpy_misc import ConstantSet, ParseCtx
-import sys, time
+import sys, time, collections, itertools, selectors, socket
+
+# have_sendmsg -- whether sockets have sendmsg() here (not on Windows);
+# without it, SocketWrap.able_send() joins pending messages to send them
+have_sendmsg = hasattr(socket.socket, "sendmsg")
 
 ## ## ## Socket wrapper
 
 class SocketWrap(object):
     """Wrap a TCP socket turning it into a means for sending
     and receiving BGP messages.  There are methods to aid integration
-    with select() too.
+    with select() too; and the attribute 'io_mask' tells what events to
+    wait for, as a mask of selectors.EVENT_READ and selectors.EVENT_WRITE.
     """
 
-    __slots__ = ["sok", "env", "ipnd", "opnd", "ista",
-                 "ibroke", "obroke", "quiet"]
+    __slots__ = ["sok", "env", "ipnd", "ipos", "opnd", "ista",
+                 "ibroke", "obroke", "quiet", "io_mask"]
     def __init__(self, sok, env):
         self.sok = sok      # connected socket
         self.env = env      # brepr.BGPEnv used in parsing
         self.ipnd = bytes() # input pending: received but not parsed / returned
-        self.opnd = bytes() # output pending: formatted but not send
+        self.ipos = 0       # position in ipnd of the first byte not yet
+                            # parsed / returned
+        self.opnd = collections.deque()
+                            # output pending: formatted but not sent; a
+                            # queue of bytes objects, sent with sendmsg()
         self.ista = False   # input status:
                             #       True -- there *may* be a message to parse
                             #       False -- there's no message to parse
         self.ibroke = False # set when connection is broken on inbound side
         self.obroke = False # set when connection is broken on outbound side
         self.quiet = False  # set to reduce output
+        self.io_mask = 0    # events of interest; see update_io_mask()
+        self.update_io_mask()
+    def update_io_mask(self):
+        """Recompute 'io_mask' from want_recv() and want_send(); called
+        whenever anything they depend on changes."""
+        self.io_mask = ((0 if self.ibroke else selectors.EVENT_READ) |
+                        (selectors.EVENT_WRITE
+                         if len(self.opnd) > 0 and not self.obroke else 0))
     def send(self, msg):
         "Queue a BGPMessage for sending"
         if self.obroke:
             bmisc.stamprint("SocketWrap.send(): disabled because connection" +
                             " was closed.")
-        self.opnd += msg.raw
+        self.opnd.append(msg.raw)
+        self.update_io_mask()
         if not self.quiet:
             bmisc.stamprint("Send: " + str(msg))
         if dbg.sokw:
             bmisc.stamprint("SocketWrap.send(): " + repr(len(msg.raw)) +
-                            " bytes added to queue, => " + repr(len(self.opnd)))
+                            " bytes added to queue, => " +
+                            repr(sum(map(len, self.opnd))))
     def recv(self):
         "Return a received BGPMessage, or None if there is none"
         if not self.ista:
@@ -77,23 +96,39 @@ class SocketWrap(object):
             if dbg.sokw:
                 bmisc.stamprint("SocketWrap.recv(): None")
             return(None)
-        if len(self.ipnd) < 19:
+        ipnd = self.ipnd
+        ipos = self.ipos
+        if len(ipnd) - ipos < 19:
             # there isn't a full header
             if dbg.sokw:
                 bmisc.stamprint("SocketWrap.recv(): not a full header yet")
             self.ista = False
             return(None)
         # read the message length field of the header
-        ml = (self.ipnd[16] << 8) + self.ipnd[17]
-        if len(self.ipnd) < ml:
+        ml = (ipnd[ipos + 16] << 8) + ipnd[ipos + 17]
+        if ml < 19 or ml > 4096:
+            # not a valid length; there's no finding where the next message
+            # starts after it, so give up on receiving, and tell the peer
+            # why (RFC 4271 6.1).  The caller can tell from 'ibroke'.
+            bmisc.stamprint("SocketWrap.recv(): bad message length " +
+                            repr(ml) + ", won't receive any more")
+            self.ibroke = True
+            self.ista = False
+            self.send(brepr.BGPNotification(self.env,
+                                            brepr.err_code.msghdr,
+                                            brepr.err_sub_msghdr.msglen,
+                                            ipnd[(ipos + 16):(ipos + 18)]))
+            return(None)
+        if len(ipnd) - ipos < ml:
             # there isn't a full message
             if dbg.sokw:
                 bmisc.stamprint("SocketWrap.recv(): not a full message yet")
             self.ista = False
             return(None)
-        # consume, parse, and return the message
-        mr = self.ipnd[:ml]
-        self.ipnd = self.ipnd[ml:]
+        # consume, parse, and return the message; just advance ipos rather
+        # than copying what's left of ipnd each time
+        mr = ipnd[ipos:(ipos + ml)]
+        self.ipos = ipos + ml
         if dbg.sokw:
             bmisc.stamprint("SocketWrap.recv(): message, " +
                             repr(ml) + " bytes")
@@ -117,7 +152,7 @@ class SocketWrap(object):
         if self.ibroke:
             bmisc.stamprint("SocketWrap.able_recv() doing nothing: conn broken")
             return
-        get = 512
+        get = 65536 # take all that's there, if it's not a huge amount
         try:
             got = self.sok.recv(get)
         except BrokenPipeError:
@@ -126,13 +161,20 @@ class SocketWrap(object):
             got = bytes()
 
         if len(got):
-            self.ipnd += got        # we got something: buffer it
+            # we got something: buffer it, dropping what's been consumed
+            if self.ipos:
+                self.ipnd = self.ipnd[self.ipos:] + got
+                self.ipos = 0
+            else:
+                self.ipnd += got
             self.ista = True        # and it *might* be a message
-            if self.env.data_cb is not None:
-                self.env.data_cb(self, "r", got)
+            data_cb = self.env.data_cb
+            if data_cb is not None:
+                data_cb(self, "r", got)
         else:
             # Connection has been closed
             self.ibroke = True
+            self.update_io_mask()
             if dbg.sokw:
                 bmisc.stamprint("connection closure detected on recv")
             return(False)
@@ -144,19 +186,42 @@ class SocketWrap(object):
         if self.obroke:
             bmisc.stamprint("SocketWrap.able_send() doing nothing: conn broken")
             return
+        opnd = self.opnd
         try:
-            sent = self.sok.send(self.opnd)
+            if len(opnd) == 1:
+                sent = self.sok.send(opnd[0])
+            elif have_sendmsg:
+                # several pending, send as many as we can with one call
+                sent = self.sok.sendmsg(list(itertools.islice(opnd, 64)))
+            else:
+                sent = self.sok.send(b"".join(itertools.islice(opnd, 64)))
         except BrokenPipeError:
             sent = 0
         except ConnectionResetError:
             sent = 0
         if sent > 0:
-            # we sent something, remove it from the output buffer
-            if self.env.data_cb is not None:
-                self.env.data_cb(self, "w", self.opnd[:sent])
-            self.opnd = self.opnd[sent:]
+            # we sent something, remove it from the output queue
+            data_cb = self.env.data_cb
+            done = [] if data_cb is not None else None
+            left = sent
+            while left > 0:
+                buf = opnd[0]
+                if len(buf) <= left:
+                    opnd.popleft()
+                    left -= len(buf)
+                else:
+                    # partly sent
+                    opnd[0] = buf[left:]
+                    buf = buf[:left]
+                    left = 0
+                if done is not None: done.append(buf)
+            if data_cb is not None:
+                data_cb(self, "w", b"".join(done))
+            if not opnd:
+                self.update_io_mask()
         else:
             self.obroke = True
+            self.update_io_mask()
             if dbg.sokw:
                 bmisc.stamprint("connection closure detected on send")
     def set_quiet(self, q):
@@ -33,7 +33,10 @@ intended when connected to a real BGP implementation is the goal."""
 
 from sys import stderr
 import bgpy_misc as bmisc
+import bgpy_repr as brepr
+import bgpy_oper as boper
 import random
+import selectors
 
 class TestFailureError(Exception):
     def __init__(self, msg = "Mismatch, test failed", g = None, e = None):
@@ -58,7 +61,13 @@ supersplit_tv = [
     (("alpha\nbeta\\ygammaydelta", "y"), ["alpha", "betaygamma"]),
     (("alpha\\ beta gamma\\ delta",), ["alpha beta", "gamma delta"]),
     (("this \"is \\a\" te\\163\\x74",), ["this", "is \a", "test"]),
-    (("w\\u0078yz\\r\\n\\b\\t",), ["wxyz\r\n\b\t"])
+    (("w\\u0078yz\\r\\n\\b\\t",), ["wxyz\r\n\b\t"]),
+    (("run idler 5 # comment", "#"), ["run", "idler", "5"]),
+    (("run \"idler\" 5 # comment", "#"), ["run", "idler", "5"]),
+    (("# comment", "#"), []),
+    (("echo a#b", "#"), ["echo", "a"]),
+    (("echo \"a#b\"", "#"), ["echo", "a#b"]),
+    (("echo a\\#b", "#"), ["echo", "a#b"])
 ]
 def supersplit_test(tv = supersplit_tv):
     """Test bmisc.supersplit()"""
@@ -446,6 +455,49 @@ def parse_ipv6_test():
 
     print("parse_ipv6_test completed ok", file=stderr)
 
+def parse_ipv4_test():
+    """Test bmisc.parse_ipv4()."""
+
+    # test vector: cases that should succeed
+    tv = [
+        ("0.0.0.0", [0, 0, 0, 0]),
+        ("10.1.2.3", [10, 1, 2, 3]),
+        ("255.255.255.255", [255, 255, 255, 255]),
+        ("192.168.0.1", [192, 168, 0, 1])
+    ]
+
+    # test vector: cases that should fail
+    tv2 = [
+        "", "1.2.3", "1.2.3.4.5", "1..2.3", "256.1.1.1", "1.2.3.-1",
+        "a.b.c.d", "1.2.3.4."
+    ]
+
+    # do the positive tests
+    for tin, tex in tv:
+        print("input "+repr(tin)+":", file=stderr)
+        tou = list(bmisc.parse_ipv4(tin))
+        print("\texp: "+repr(tex), file=stderr)
+        print("\tgot: "+repr(tou), file=stderr)
+        if tex != tou:
+            raise TestFailureError()
+
+    # do the negative tests
+    for tin in tv2:
+        print("input "+repr(tin)+":", file=stderr)
+        try:
+            tou = list(bmisc.parse_ipv4(tin))
+            gotf = False
+            got = repr(tou)
+        except Exception as e:
+            gotf = True
+            got = "failure: "+str(e)
+        print("\texp: failure", file=stderr)
+        print("\tgot: "+got, file=stderr)
+        if not gotf:
+            raise TestFailureError()
+
+    print("parse_ipv4_test completed ok", file=stderr)
+
 def Partition_test(count = 3, size = 10, seed = 123, verbose = False):
     """Test bmisc.Partition()."""
 
@@ -550,3 +602,196 @@ def mask_check_test(count=1000, seed=1, verbose=False):
             raise TestFailureError()
 
     print("make_check_test completed ok", file=stderr)
+
+## ## ## Test boper.SocketWrap
+
+class FakeSocket(object):
+    """Stands in for a connected socket in the SocketWrap tests.  send()
+    and sendmsg() accept at most 'limit' bytes per call (or everything if
+    it's None), and remember what they accepted and how they were called;
+    recv() returns 'chunks' one at a time, no more than it's asked for,
+    then b"" (end of file)."""
+
+    def __init__(self, limit = None, chunks = []):
+        self.limit = limit
+        self.sent = bytearray()
+        self.calls = [] # ("send", bytes) or ("sendmsg", number of buffers)
+        self.chunks = list(chunks)
+        self.recv_sizes = set()
+    def take(self, data):
+        if self.limit is not None:
+            data = data[:self.limit]
+        self.sent += data
+        return(len(data))
+    def send(self, data):
+        self.calls.append(("send", len(data)))
+        return(self.take(bytes(data)))
+    def sendmsg(self, bufs):
+        self.calls.append(("sendmsg", len(bufs)))
+        return(self.take(b"".join(bufs)))
+    def recv(self, n):
+        self.recv_sizes.add(n)
+        if not self.chunks:
+            return(b"")
+        chunk = self.chunks.pop(0)
+        if len(chunk) > n:
+            self.chunks.insert(0, chunk[n:])
+            chunk = chunk[:n]
+        return(chunk)
+
+def socketwrap_test_messages(env, prng, count, maxdata):
+    """Make a list of 'count' BGP messages (keepalives and notifications
+    with random data of up to 'maxdata' bytes) for the SocketWrap tests."""
+
+    msgs = []
+    for i in range(count):
+        if prng.randrange(4) == 0:
+            msgs.append(brepr.BGPKeepalive(env))
+        else:
+            data = bytes(prng.randrange(256)
+                         for j in range(prng.randrange(maxdata + 1)))
+            msgs.append(brepr.BGPNotification(env, prng.randrange(1, 7),
+                                              prng.randrange(4), data))
+    return(msgs)
+
+def SocketWrap_send_test(count = 200, seed = 17, verbose = False):
+    """Test boper.SocketWrap.send() and able_send(): partial sends, the
+    64 buffer limit on sendmsg(), the send() fallback when there's no
+    sendmsg(), and the 'io_mask' updates."""
+
+    R = selectors.EVENT_READ
+    W = selectors.EVENT_WRITE
+
+    # a simple case first: a partial send leaves the rest of a message
+    # at the head of the queue
+    env = brepr.BGPEnv()
+    msgs = [brepr.BGPNotification(env, 1, 2, bytes(range(n)))
+            for n in (2, 9, 19)]
+    sok = FakeSocket(limit = 50)
+    sw = boper.SocketWrap(sok, env)
+    sw.set_quiet(True)
+    for msg in msgs: sw.send(msg)
+    sw.able_send()
+    got = (bytes(sok.sent), list(sw.opnd), sok.calls)
+    exp = (msgs[0].raw + msgs[1].raw[:27],
+           [msgs[1].raw[27:], msgs[2].raw], [("sendmsg", 3)])
+    print("partial send:", file=stderr)
+    print("	got: "+repr(got), file=stderr)
+    print("	exp: "+repr(exp), file=stderr)
+    if got != exp: raise TestFailureError()
+
+    prng = random.Random(seed)
+    saved_have_sendmsg = boper.have_sendmsg
+    try:
+        for i in range(count):
+            boper.have_sendmsg = (i % 2 == 0)
+            env = brepr.BGPEnv()
+            cbdata = bytearray()
+            def data_cb(wrpsok, rw, data):
+                if rw != "w": raise TestFailureError("data_cb() "+repr(rw))
+                cbdata.extend(data)
+            env.data_cb = data_cb
+            msgs = socketwrap_test_messages(env, prng, prng.randrange(1, 150),
+                                            prng.choice([0, 10, 300]))
+            exp = b"".join(msg.raw for msg in msgs)
+            limit = prng.choice([None, 1, 7, 100, 1000, 20000])
+            sok = FakeSocket(limit = limit)
+            sw = boper.SocketWrap(sok, env)
+            sw.set_quiet(True)
+            if sw.io_mask != R:
+                raise TestFailureError("io_mask", sw.io_mask, R)
+            for msg in msgs:
+                sw.send(msg)
+            if sw.io_mask != R | W:
+                raise TestFailureError("io_mask", sw.io_mask, R | W)
+            for j in range(len(exp) + 1):
+                if not sw.opnd: break
+                sw.able_send()
+                if sw.io_mask != (R | W if sw.opnd else R):
+                    raise TestFailureError("io_mask", sw.io_mask, len(sw.opnd))
+            if verbose:
+                print(repr((i, len(msgs), limit, boper.have_sendmsg)) +
+                      ": " + repr(sok.calls), file=stderr)
+            if bytes(sok.sent) != exp or bytes(cbdata) != exp:
+                raise TestFailureError("sent data mismatch in trial "+str(i))
+            for how, n in sok.calls:
+                if how == "sendmsg" and (not boper.have_sendmsg or n > 64):
+                    raise TestFailureError("bad call", (how, n))
+            # with everything sent at once, the first call is the whole
+            # queue, or the first 64 messages of it
+            if limit is None:
+                if len(msgs) == 1:
+                    eh = ("send", len(exp))
+                elif boper.have_sendmsg:
+                    eh = ("sendmsg", min(64, len(msgs)))
+                else:
+                    eh = ("send", sum(len(msg.raw) for msg in msgs[:64]))
+                if sok.calls[0] != eh:
+                    raise TestFailureError("first call", sok.calls[0], eh)
+    finally:
+        boper.have_sendmsg = saved_have_sendmsg
+
+    print("SocketWrap_send_test completed ok", file=stderr)
+
+def SocketWrap_recv_test(count = 100, seed = 29, verbose = False):
+    """Test boper.SocketWrap.able_recv() and recv(): messages split at
+    arbitrary points (headers included) between reads, reading in
+    chunks of at most 65536 bytes, and compacting of what's buffered."""
+
+    prng = random.Random(seed)
+    for i in range(count):
+        env = brepr.BGPEnv()
+        if i == 0:
+            # big enough that it takes more than one 65536 byte read
+            msgs = socketwrap_test_messages(env, prng, 60, 4000)
+        else:
+            msgs = socketwrap_test_messages(env, prng, prng.randrange(1, 60),
+                                            prng.choice([0, 30, 4000]))
+        stream = b"".join(msg.raw for msg in msgs)
+
+        # split the stream up into the chunks that arrive; make sure
+        # some headers get split
+        if i == 0:
+            cuts = [] # all at once
+        elif i == 1:
+            cuts = list(range(1, len(stream))) # a byte at a time
+        else:
+            cuts = sorted(prng.sample(range(1, len(stream)),
+                                      min(len(stream) - 1,
+                                          prng.randrange(1, 40))))
+            cuts.append(17) # inside the first header's length field
+            cuts = sorted(set(c for c in cuts if c < len(stream)))
+        cuts = [0] + cuts + [len(stream)]
+        chunks = [stream[cuts[j]:cuts[j + 1]] for j in range(len(cuts) - 1)]
+
+        sok = FakeSocket(chunks = chunks)
+        sw = boper.SocketWrap(sok, env)
+        sw.set_quiet(True)
+        got = []
+        for j in range(len(stream) + 1):
+            if not sw.able_recv():
+                break # end of file
+            # after reading, what's been consumed is dropped
+            if sw.ipos != 0:
+                raise TestFailureError("ipos after able_recv()", sw.ipos, 0)
+            while True:
+                msg = sw.recv()
+                if msg is None: break
+                got.append(msg.raw)
+                if sw.ipos > len(sw.ipnd):
+                    raise TestFailureError("ipos past end of ipnd")
+        if verbose:
+            print(repr((i, len(msgs), len(chunks), len(stream))),
+                  file=stderr)
+        exp = [msg.raw for msg in msgs]
+        if got != exp:
+            raise TestFailureError("messages mismatch in trial "+str(i))
+        if len(sw.ipnd) != sw.ipos or not sw.ibroke:
+            raise TestFailureError("leftovers", (len(sw.ipnd), sw.ipos,
+                                                 sw.ibroke))
+        if i == 0 and len(stream) <= 65536:
+            raise TestFailureError("trial 0 stream too short")
+        if sok.recv_sizes != {65536}:
+            raise TestFailureError("recv() sizes", sok.recv_sizes, {65536})
+
+    print("SocketWrap_recv_test completed ok", file=stderr)